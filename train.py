@@ -6,6 +6,11 @@ import torchvision
 import torchvision.transforms as transforms
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+import torch.fx.experimental.optimization
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data.distributed import DistributedSampler
 import numpy as np
 import matplotlib.pyplot as plt
 from IPython.display import clear_output
@@ -13,331 +18,391 @@ from flash.core.optimizers import LARS
 from flash.core.optimizers import LAMB
 import os
 import argparse
+from functools import partial
+from datetime import datetime
+from pytz import timezone
 from nngeometry.generator import Jacobian
 from nngeometry.layercollection import LayerCollection
 
-def load_architecture(arch_id: str, num_chann: int, num_classes: int, pic_size: int) -> nn.Module:
-
-    if arch_id == 'resnet18':
-        model = torchvision.models.resnet18(num_classes=num_classes)
-        model.conv1 = nn.Conv2d(num_chann,
-                            2*pic_size,
-                            kernel_size=(3, 3),
-                            stride=(1, 1),
-                            padding=(1, 1),
-                            bias=False)
-        model.maxpool = nn.Identity()
-        model.fc = nn.Linear(in_features=512, out_features=num_classes, bias=False)
-        return model
-    elif arch_id == 'resnet34':
-        model = torchvision.models.resnet34(num_classes=num_classes)
-        model.conv1 = nn.Conv2d(num_chann,
+def cifar_resnet(builder, num_chann: int, num_classes: int, pic_size: int) -> nn.Module:
+    # torchvision resnet with a 3x3 stem, no max pooling and a bias-free head
+    model = builder(num_classes=num_classes)
+    model.conv1 = nn.Conv2d(num_chann,
                             2*pic_size,
                             kernel_size=(3, 3),
                             stride=(1, 1),
                             padding=(1, 1),
                             bias=False)
-        model.maxpool = nn.Identity()
-        model.fc = nn.Linear(in_features=512, out_features=num_classes, bias=False)
-        return model
-    elif arch_id == 'resnet50':
-        model = torchvision.models.resnet50(num_classes=num_classes)
-        model.conv1 = nn.Conv2d(num_chann,
+    model.maxpool = nn.Identity()
+    model.fc = nn.Linear(in_features=model.fc.in_features, out_features=num_classes, bias=False)
+    return model
+
+def cifar_vgg(builder, num_chann: int, num_classes: int, pic_size: int) -> nn.Module:
+    # vgg/alexnet with a 3x3 stem, the first max pooling removed and a bias-free head
+    model = builder(num_classes=num_classes)
+    model.features[0] = nn.Conv2d(num_chann,
                             2*pic_size,
                             kernel_size=(3, 3),
                             stride=(1, 1),
                             padding=(1, 1),
                             bias=False)
-        model.maxpool = nn.Identity()
-        model.fc = nn.Linear(in_features=2048, out_features=num_classes, bias=False)
-        return model
-    elif arch_id == 'vgg11':
-        model = torchvision.models.vgg11(num_classes=num_classes)
-        model.features[0] = nn.Conv2d(num_chann,
-                                2*pic_size,
-                                kernel_size=(3, 3),
-                                stride=(1, 1),
-                                padding=(1, 1),
-                                bias=False)
-        model.features[2] = nn.Identity()
-        model.classifier[6] = nn.Linear(in_features=4096, out_features=num_classes, bias=False)
-        # initial value
-        return model
-    elif arch_id == 'alexnet':
-        model = torchvision.models.alexnet(num_classes=num_classes)
-        model.features[0] = nn.Conv2d(num_chann,
+    model.features[2] = nn.Identity()
+    model.classifier[6] = nn.Linear(in_features=4096, out_features=num_classes, bias=False)
+    return model
+
+def cifar_swin(num_chann: int, num_classes: int, pic_size: int) -> nn.Module:
+    model = torchvision.models.swin_t(num_classes=num_classes)
+    model.features[0][0] = nn.Conv2d(num_chann,
                             2*pic_size,
                             kernel_size=(3, 3),
                             stride=(1, 1),
                             padding=(1, 1),
                             bias=False)
-        model.features[2] = nn.Identity()
-        model.classifier[6] = nn.Linear(in_features=4096, out_features=num_classes, bias=False)
-        return model
-    elif arch_id == 'vit':
-        class Residual(nn.Module):
-            def __init__(self, *layers):
-                super().__init__()
-                self.residual = nn.Sequential(*layers)
-                self.gamma = nn.Parameter(torch.zeros(1))
-            
-            def forward(self, x):
-                return x + self.gamma * self.residual(x)
-
-        class LayerNormChannels(nn.Module):
-            def __init__(self, channels):
-                super().__init__()
-                self.norm = nn.LayerNorm(channels)
-            
-            def forward(self, x):
-                x = x.transpose(1, -1)
-                x = self.norm(x)
-                x = x.transpose(-1, 1)
-                return x
-
-        class SelfAttention2d(nn.Module):
-            def __init__(self, in_channels, out_channels, head_channels, shape):
-                super().__init__()
-                self.heads = out_channels // head_channels
-                self.head_channels = head_channels
-                self.scale = head_channels**-0.5
-                
-                self.to_keys = nn.Conv2d(in_channels, out_channels, 1)
-                self.to_queries = nn.Conv2d(in_channels, out_channels, 1)
-                self.to_values = nn.Conv2d(in_channels, out_channels, 1)
-                self.unifyheads = nn.Conv2d(out_channels, out_channels, 1)
-                
-                height, width = shape
-                self.pos_enc = nn.Parameter(torch.Tensor(self.heads, (2 * height - 1) * (2 * width - 1)))
-                self.register_buffer("relative_indices", self.get_indices(height, width))
-            
-            def forward(self, x):
-                b, _, h, w = x.shape
-                
-                keys = self.to_keys(x).view(b, self.heads, self.head_channels, -1)
-                values = self.to_values(x).view(b, self.heads, self.head_channels, -1)
-                queries = self.to_queries(x).view(b, self.heads, self.head_channels, -1)
-                
-                att = keys.transpose(-2, -1) @ queries
-                
-                indices = self.relative_indices.expand(self.heads, -1)
-                rel_pos_enc = self.pos_enc.gather(-1, indices)
-                rel_pos_enc = rel_pos_enc.unflatten(-1, (h * w, h * w))
-                
-                att = att * self.scale + rel_pos_enc
-                att = F.softmax(att, dim=-2)
-                
-                out = values @ att
-                out = out.view(b, -1, h, w)
-                out = self.unifyheads(out)
-                return out
-            
-            @staticmethod
-            def get_indices(h, w):
-                y = torch.arange(h, dtype=torch.long)
-                x = torch.arange(w, dtype=torch.long)
-                
-                y1, x1, y2, x2 = torch.meshgrid(y, x, y, x, indexing='ij')
-                indices = (y1 - y2 + h - 1) * (2 * w - 1) + x1 - x2 + w - 1
-                indices = indices.flatten()
-                
-                return indices
-
-        class FeedForward(nn.Sequential):
-            def __init__(self, in_channels, out_channels, mult=4):
-                hidden_channels = in_channels * mult
-                super().__init__(
-                    nn.Conv2d(in_channels, hidden_channels, 1),
-                    nn.GELU(),
-                    nn.Conv2d(hidden_channels, out_channels, 1)   
-                )
+    model.head = torch.nn.Linear(in_features=768, out_features=num_classes, bias=False)
+    return model
 
-        class TransformerBlock(nn.Sequential):
-            def __init__(self, channels, head_channels, shape, p_drop=0.):
-                super().__init__(
-                    Residual(
-                        LayerNormChannels(channels),
-                        SelfAttention2d(channels, channels, head_channels, shape),
-                        nn.Dropout(p_drop)
-                    ),
-                    Residual(
-                        LayerNormChannels(channels),
-                        FeedForward(channels, channels),
-                        nn.Dropout(p_drop)
-                    )
+def relvit(num_chann: int, num_classes: int, pic_size: int) -> nn.Module:
+    class Residual(nn.Module):
+        def __init__(self, *layers):
+            super().__init__()
+            self.residual = nn.Sequential(*layers)
+            self.gamma = nn.Parameter(torch.zeros(1))
+
+        def forward(self, x):
+            return x + self.gamma * self.residual(x)
+
+    class LayerNormChannels(nn.Module):
+        def __init__(self, channels):
+            super().__init__()
+            self.norm = nn.LayerNorm(channels)
+
+        def forward(self, x):
+            x = x.transpose(1, -1)
+            x = self.norm(x)
+            x = x.transpose(-1, 1)
+            return x
+
+    class SelfAttention2d(nn.Module):
+        def __init__(self, in_channels, out_channels, head_channels, shape):
+            super().__init__()
+            self.heads = out_channels // head_channels
+            self.head_channels = head_channels
+            self.scale = head_channels**-0.5
+
+            self.to_keys = nn.Conv2d(in_channels, out_channels, 1)
+            self.to_queries = nn.Conv2d(in_channels, out_channels, 1)
+            self.to_values = nn.Conv2d(in_channels, out_channels, 1)
+            self.unifyheads = nn.Conv2d(out_channels, out_channels, 1)
+
+            height, width = shape
+            self.pos_enc = nn.Parameter(torch.Tensor(self.heads, (2 * height - 1) * (2 * width - 1)))
+            self.register_buffer("relative_indices", self.get_indices(height, width))
+
+        def forward(self, x):
+            b, _, h, w = x.shape
+
+            keys = self.to_keys(x).view(b, self.heads, self.head_channels, -1)
+            values = self.to_values(x).view(b, self.heads, self.head_channels, -1)
+            queries = self.to_queries(x).view(b, self.heads, self.head_channels, -1)
+
+            att = keys.transpose(-2, -1) @ queries
+
+            indices = self.relative_indices.expand(self.heads, -1)
+            rel_pos_enc = self.pos_enc.gather(-1, indices)
+            rel_pos_enc = rel_pos_enc.unflatten(-1, (h * w, h * w))
+
+            att = att * self.scale + rel_pos_enc
+            att = F.softmax(att, dim=-2)
+
+            out = values @ att
+            out = out.view(b, -1, h, w)
+            out = self.unifyheads(out)
+            return out
+
+        @staticmethod
+        def get_indices(h, w):
+            y = torch.arange(h, dtype=torch.long)
+            x = torch.arange(w, dtype=torch.long)
+
+            y1, x1, y2, x2 = torch.meshgrid(y, x, y, x, indexing='ij')
+            indices = (y1 - y2 + h - 1) * (2 * w - 1) + x1 - x2 + w - 1
+            indices = indices.flatten()
+
+            return indices
+
+    class FeedForward(nn.Sequential):
+        def __init__(self, in_channels, out_channels, mult=4):
+            hidden_channels = in_channels * mult
+            super().__init__(
+                nn.Conv2d(in_channels, hidden_channels, 1),
+                nn.GELU(),
+                nn.Conv2d(hidden_channels, out_channels, 1)   
+            )
+
+    class TransformerBlock(nn.Sequential):
+        def __init__(self, channels, head_channels, shape, p_drop=0.):
+            super().__init__(
+                Residual(
+                    LayerNormChannels(channels),
+                    SelfAttention2d(channels, channels, head_channels, shape),
+                    nn.Dropout(p_drop)
+                ),
+                Residual(
+                    LayerNormChannels(channels),
+                    FeedForward(channels, channels),
+                    nn.Dropout(p_drop)
                 )
+            )
+
+    class TransformerStack(nn.Sequential):
+        def __init__(self, num_blocks, channels, head_channels, shape, p_drop=0.):
+            layers = [TransformerBlock(channels, head_channels, shape, p_drop) for _ in range(num_blocks)]
+            super().__init__(*layers)
+
+    """Embedding of patches"""
+
+    class ToPatches(nn.Sequential):
+        def __init__(self, in_channels, channels, patch_size, hidden_channels=32):
+            super().__init__(
+                nn.Conv2d(in_channels, hidden_channels, 3, padding=1),
+                nn.GELU(),
+                nn.Conv2d(hidden_channels, channels, patch_size, stride=patch_size)
+            )
+
+    class AddPositionEmbedding(nn.Module):
+        def __init__(self, channels, shape):
+            super().__init__()
+            self.pos_embedding = nn.Parameter(torch.Tensor(channels, *shape))
+
+        def forward(self, x):
+            return x + self.pos_embedding
+
+    class ToEmbedding(nn.Sequential):
+        def __init__(self, in_channels, channels, patch_size, shape, p_drop=0.):
+            super().__init__(
+                ToPatches(in_channels, channels, patch_size),
+                AddPositionEmbedding(channels, shape),
+                nn.Dropout(p_drop)
+            )
+
+    """Main model"""
+
+    class Head(nn.Sequential):
+        def __init__(self, in_channels, classes, p_drop=0.):
+            super().__init__(
+                LayerNormChannels(in_channels),
+                nn.GELU(),
+                nn.AdaptiveAvgPool2d(1),
+                nn.Flatten(),
+                nn.Dropout(p_drop),
+                nn.Linear(in_channels, classes)
+            )
+
+    class RelViT(nn.Sequential):
+        def __init__(self, classes, image_size, channels, head_channels, num_blocks, patch_size,
+                    in_channels=3, emb_p_drop=0., trans_p_drop=0., head_p_drop=0.):
+            reduced_size = image_size // patch_size
+            shape = (reduced_size, reduced_size)
+            super().__init__(
+                ToEmbedding(in_channels, channels, patch_size, shape, emb_p_drop),
+                TransformerStack(num_blocks, channels, head_channels, shape, trans_p_drop),
+                Head(channels, classes, head_p_drop)
+            )
+            self.reset_parameters()
+
+        def reset_parameters(self):
+            for m in self.modules():
+                if isinstance(m, (nn.Conv2d, nn.Linear)):
+                    nn.init.kaiming_normal_(m.weight)
+                    if m.bias is not None: nn.init.zeros_(m.bias)
+                elif isinstance(m, nn.LayerNorm):
+                    nn.init.constant_(m.weight, 1.)
+                    nn.init.zeros_(m.bias)
+                elif isinstance(m, AddPositionEmbedding):
+                    nn.init.normal_(m.pos_embedding, mean=0.0, std=0.02)
+                elif isinstance(m, SelfAttention2d):
+                    nn.init.normal_(m.pos_enc, mean=0.0, std=0.02)
+                elif isinstance(m, Residual):
+                    nn.init.zeros_(m.gamma)
+
+        def separate_parameters(self):
+            parameters_decay = set()
+            parameters_no_decay = set()
+            modules_weight_decay = (nn.Linear, nn.Conv2d)
+            modules_no_weight_decay = (nn.LayerNorm,)
+
+            for m_name, m in self.named_modules():
+                for param_name, param in m.named_parameters():
+                    full_param_name = f"{m_name}.{param_name}" if m_name else param_name
+
+                    if isinstance(m, modules_no_weight_decay):
+                        parameters_no_decay.add(full_param_name)
+                    elif param_name.endswith("bias"):
+                        parameters_no_decay.add(full_param_name)
+                    elif isinstance(m, Residual) and param_name.endswith("gamma"):
+                        parameters_no_decay.add(full_param_name)
+                    elif isinstance(m, AddPositionEmbedding) and param_name.endswith("pos_embedding"):
+                        parameters_no_decay.add(full_param_name)
+                    elif isinstance(m, SelfAttention2d) and param_name.endswith("pos_enc"):
+                        parameters_no_decay.add(full_param_name)
+                    elif isinstance(m, modules_weight_decay):
+                        parameters_decay.add(full_param_name)
+
+            # sanity check
+            assert len(parameters_decay & parameters_no_decay) == 0
+            assert len(parameters_decay) + len(parameters_no_decay) == len(list(model.parameters()))
+
+            return parameters_decay, parameters_no_decay
+
+    model = RelViT(num_classes, 32, channels=256, head_channels=32, num_blocks=8, patch_size=2,emb_p_drop=0., trans_p_drop=0., head_p_drop=0.3)
+    model[2][5] = torch.nn.Linear(in_features=256, out_features=num_classes, bias=False)
+    return model
 
-        class TransformerStack(nn.Sequential):
-            def __init__(self, num_blocks, channels, head_channels, shape, p_drop=0.):
-                layers = [TransformerBlock(channels, head_channels, shape, p_drop) for _ in range(num_blocks)]
-                super().__init__(*layers)
+ARCHITECTURES = {
+    'resnet18': partial(cifar_resnet, torchvision.models.resnet18),
+    'resnet34': partial(cifar_resnet, torchvision.models.resnet34),
+    'resnet50': partial(cifar_resnet, torchvision.models.resnet50),
+    'vgg11': partial(cifar_vgg, torchvision.models.vgg11),
+    'alexnet': partial(cifar_vgg, torchvision.models.alexnet),
+    'vit': relvit,
+    'wide-resnet': partial(cifar_resnet, torchvision.models.wide_resnet50_2),
+    'swim-net': cifar_swin,
+}
 
-        """Embedding of patches"""
+def load_architecture(arch_id: str, num_chann: int, num_classes: int, pic_size: int) -> nn.Module:
+    if arch_id not in ARCHITECTURES:
+        raise NotImplementedError('unknown model: '+arch_id)
+    return ARCHITECTURES[arch_id](num_chann, num_classes, pic_size)
 
-        class ToPatches(nn.Sequential):
-            def __init__(self, in_channels, channels, patch_size, hidden_channels=32):
-                super().__init__(
-                    nn.Conv2d(in_channels, hidden_channels, 3, padding=1),
-                    nn.GELU(),
-                    nn.Conv2d(hidden_channels, channels, patch_size, stride=patch_size)
-                )
+# module whose output is the feature map phi fed to the last linear layer
+def penultimate_module(model, arch_id):
+    if arch_id == 'vgg11' or arch_id == 'alexnet':
+        return model.classifier[5]
+    elif arch_id == 'vit':
+        return model[2][4]
+    else:
+        return list(model._modules.values())[-2]
+
+# recompute activations of a sequential stage during backward instead of storing them
+class CheckpointSequential(nn.Module):
+    def __init__(self, module, segments):
+        super().__init__()
+        self.module = module
+        self.segments = min(segments, len(module))
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()):
+            return self.module(x)
+        # same split as checkpoint_sequential, the last segment keeps its activations
+        layers = list(self.module)
+        size = len(layers) // self.segments
+        for start in range(0, size * (self.segments - 1), size):
+            x = torch.utils.checkpoint.checkpoint(self.segment(layers[start:start + size]), x, use_reentrant=False)
+        for layer in layers[size * (self.segments - 1):]:
+            x = layer(x)
+        return x
+
+    @staticmethod
+    def segment(layers):
+        # backward reruns the segment in train mode, which would update the batchnorm running
+        # stats a second time; the rerun gets throwaway copies so each step updates them once
+        bns = [m for layer in layers for m in layer.modules()
+               if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.track_running_stats]
+        first = [True]
+        def run(x):
+            recompute, first[0] = not first[0], False
+            if recompute:
+                saved = [(m, m.running_mean, m.running_var, m.num_batches_tracked) for m in bns]
+                for m in bns:
+                    m.running_mean, m.running_var = m.running_mean.clone(), m.running_var.clone()
+                    m.num_batches_tracked = m.num_batches_tracked.clone()
+            try:
+                for layer in layers:
+                    x = layer(x)
+                return x
+            finally:
+                if recompute:
+                    for m, mean, var, num in saved:
+                        m.running_mean, m.running_var, m.num_batches_tracked = mean, var, num
+        return run
+
+def checkpoint_stages(model, arch_id, segments):
+    if arch_id in ('resnet18', 'resnet34', 'resnet50', 'wide-resnet'):
+        for name in ('layer1', 'layer2', 'layer3', 'layer4'):
+            setattr(model, name, CheckpointSequential(getattr(model, name), segments))
+    elif arch_id == 'vgg11':
+        model.features = CheckpointSequential(model.features, segments)
+    else:
+        raise NotImplementedError('activation checkpointing not supported for model: '+arch_id)
+    return model
 
-        class AddPositionEmbedding(nn.Module):
-            def __init__(self, channels, shape):
-                super().__init__()
-                self.pos_embedding = nn.Parameter(torch.Tensor(channels, *shape))
-            
-            def forward(self, x):
-                return x + self.pos_embedding
-
-        class ToEmbedding(nn.Sequential):
-            def __init__(self, in_channels, channels, patch_size, shape, p_drop=0.):
-                super().__init__(
-                    ToPatches(in_channels, channels, patch_size),
-                    AddPositionEmbedding(channels, shape),
-                    nn.Dropout(p_drop)
-                )
+# normalization constants, applied on the device to uint8 batches
+def data_stats(dataset, train=True):
+    if dataset == 'Cifar10':
+        # the Cifar10 training set has always been normalized with single-channel stats
+        if train:
+            return (0.1307,), (0.3081,)
+        return (0.4914, 0.4822, 0.4465), (0.2471, 0.2435, 0.2616)
+    elif dataset == 'Cifar100':
+        return (0.5071, 0.4867, 0.4408), (0.2675, 0.2565, 0.2761)
+    elif dataset == 'Imagenet':
+        return (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    else:
+        raise NotImplementedError('unknown dataset: '+dataset)
+
+class DeviceNormalize:
+    def __init__(self, param_mean, param_std, device):
+        # (x/255 - mean)/std == (x - 255*mean)/(255*std)
+        self.mean = 255 * torch.tensor(param_mean, device=device).view(1, -1, 1, 1)
+        self.std = 255 * torch.tensor(param_std, device=device).view(1, -1, 1, 1)
+
+    def __call__(self, inputs):
+        return (inputs.float() - self.mean) / self.std
+
+# whole CIFAR split held as a (N, C, H, W) uint8 tensor, transforms act on tensors instead of PIL images
+_cifar_cache = {}
+class CachedCIFAR(torch.utils.data.Dataset):
+    def __init__(self, dataset, train, transform=None):
+        key = (dataset, train)
+        if key not in _cifar_cache:
+            if dataset == 'Cifar10':
+                raw = torchvision.datasets.CIFAR10(root='./data', train=train, download=True)
+            else:
+                raw = torchvision.datasets.CIFAR100(root='./data', train=train, download=True)
+            _cifar_cache[key] = (torch.from_numpy(raw.data).permute(0, 3, 1, 2).contiguous(),
+                                 torch.tensor(raw.targets))
+        self.data, self.targets = _cifar_cache[key]
+        self.transform = transform
 
-        """Main model"""
-
-        class Head(nn.Sequential):
-            def __init__(self, in_channels, classes, p_drop=0.):
-                super().__init__(
-                    LayerNormChannels(in_channels),
-                    nn.GELU(),
-                    nn.AdaptiveAvgPool2d(1),
-                    nn.Flatten(),
-                    nn.Dropout(p_drop),
-                    nn.Linear(in_channels, classes)
-                )
+    def __len__(self):
+        return len(self.targets)
 
-        class RelViT(nn.Sequential):
-            def __init__(self, classes, image_size, channels, head_channels, num_blocks, patch_size,
-                        in_channels=3, emb_p_drop=0., trans_p_drop=0., head_p_drop=0.):
-                reduced_size = image_size // patch_size
-                shape = (reduced_size, reduced_size)
-                super().__init__(
-                    ToEmbedding(in_channels, channels, patch_size, shape, emb_p_drop),
-                    TransformerStack(num_blocks, channels, head_channels, shape, trans_p_drop),
-                    Head(channels, classes, head_p_drop)
-                )
-                self.reset_parameters()
-            
-            def reset_parameters(self):
-                for m in self.modules():
-                    if isinstance(m, (nn.Conv2d, nn.Linear)):
-                        nn.init.kaiming_normal_(m.weight)
-                        if m.bias is not None: nn.init.zeros_(m.bias)
-                    elif isinstance(m, nn.LayerNorm):
-                        nn.init.constant_(m.weight, 1.)
-                        nn.init.zeros_(m.bias)
-                    elif isinstance(m, AddPositionEmbedding):
-                        nn.init.normal_(m.pos_embedding, mean=0.0, std=0.02)
-                    elif isinstance(m, SelfAttention2d):
-                        nn.init.normal_(m.pos_enc, mean=0.0, std=0.02)
-                    elif isinstance(m, Residual):
-                        nn.init.zeros_(m.gamma)
-            
-            def separate_parameters(self):
-                parameters_decay = set()
-                parameters_no_decay = set()
-                modules_weight_decay = (nn.Linear, nn.Conv2d)
-                modules_no_weight_decay = (nn.LayerNorm,)
-
-                for m_name, m in self.named_modules():
-                    for param_name, param in m.named_parameters():
-                        full_param_name = f"{m_name}.{param_name}" if m_name else param_name
-
-                        if isinstance(m, modules_no_weight_decay):
-                            parameters_no_decay.add(full_param_name)
-                        elif param_name.endswith("bias"):
-                            parameters_no_decay.add(full_param_name)
-                        elif isinstance(m, Residual) and param_name.endswith("gamma"):
-                            parameters_no_decay.add(full_param_name)
-                        elif isinstance(m, AddPositionEmbedding) and param_name.endswith("pos_embedding"):
-                            parameters_no_decay.add(full_param_name)
-                        elif isinstance(m, SelfAttention2d) and param_name.endswith("pos_enc"):
-                            parameters_no_decay.add(full_param_name)
-                        elif isinstance(m, modules_weight_decay):
-                            parameters_decay.add(full_param_name)
-
-                # sanity check
-                assert len(parameters_decay & parameters_no_decay) == 0
-                assert len(parameters_decay) + len(parameters_no_decay) == len(list(model.parameters()))
-
-                return parameters_decay, parameters_no_decay
-
-        model = RelViT(num_classes, 32, channels=256, head_channels=32, num_blocks=8, patch_size=2,emb_p_drop=0., trans_p_drop=0., head_p_drop=0.3)
-        model[2][5] = torch.nn.Linear(in_features=256, out_features=num_classes, bias=False)
-        return model
-    elif arch_id == 'wide-resnet':
-        model = torchvision.models.wide_resnet50_2(num_classes=num_classes)
-        model.conv1 = nn.Conv2d(num_chann,
-                                2*pic_size,
-                                kernel_size=(3, 3),
-                                stride=(1, 1),
-                                padding=(1, 1),
-                                bias=False)
-        model.maxpool = nn.Identity()
-        model.fc = torch.nn.Linear(in_features=2048, out_features=num_classes, bias=False)
-        return model
-    elif arch_id == 'swim-net':
-        model = torchvision.models.swin_t(num_classes=num_classes)
-        model.features[0][0] = nn.Conv2d(num_chann,
-                                2*pic_size,
-                                kernel_size=(3, 3),
-                                stride=(1, 1),
-                                padding=(1, 1),
-                                bias=False)
-        model.head = torch.nn.Linear(in_features=768, out_features=num_classes, bias=False)
-        return model
-    else:
-        raise NotImplementedError('unknown model: '+arch_id)
+    def __getitem__(self, index):
+        img = self.data[index]
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, self.targets[index]
 
 # load training data
-def load_train_data(batch_size, dataset, num_workers):
+def load_train_data(batch_size, dataset, num_workers, distributed=False):
 
+    # workers only crop/flip uint8 tensors, normalization happens on the device
     if dataset == 'Cifar10':
-        param_mean = (0.4914, 0.4822, 0.4465)
-        param_std = (0.2471, 0.2435, 0.2616
-                 )
-        transform_train = transforms.Compose([
-            torchvision.transforms.RandomCrop(32, padding=4),
-            torchvision.transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(param_mean, param_std),
-        ])
-
-        train_set = torchvision.datasets.CIFAR10(root='./data',
-                                                train=True,
-                                                download=True,
-                                                transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))]))
+        train_set = CachedCIFAR(dataset, train=True)
 
     elif dataset == 'Cifar100':
-        param_mean = (0.5071, 0.4867, 0.4408)
-        param_std = (0.2675, 0.2565, 0.2761)
-                 
         transform_train = transforms.Compose([
             torchvision.transforms.RandomCrop(32, padding=4),
             torchvision.transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(param_mean, param_std),
         ])
 
-        train_set = torchvision.datasets.CIFAR100(root='./data',
-                                                train=True,
-                                                download=True,
-                                                transform=transform_train)
+        train_set = CachedCIFAR(dataset, train=True, transform=transform_train)
                                                 
     elif dataset == 'Imagenet':
-        param_mean = [0.485, 0.456, 0.406]
-        param_std = [0.229, 0.224, 0.225]
-                 
         transform_train = transforms.Compose([
             torchvision.transforms.RandomCrop(32, padding=4),
             torchvision.transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
-            transforms.Normalize(param_mean, param_std),
+            transforms.PILToTensor(),
         ])
 
         train_set = torchvision.datasets.ImageNet(root='./data',
@@ -347,64 +412,100 @@ def load_train_data(batch_size, dataset, num_workers):
     else:
         raise NotImplementedError('unknown dataset: '+dataset)                                                                                
 
+    # each rank sees its own shard when running under torchrun
+    sampler = DistributedSampler(train_set, shuffle=True) if distributed else None
+    # torch<2.0 rejects any prefetch_factor, even None, without worker processes
+    worker_kw = {'persistent_workers': True, 'prefetch_factor': 2} if num_workers > 0 else {}
     train_loader = torch.utils.data.DataLoader(train_set,
                                                batch_size=batch_size,
-                                               shuffle=True,
-                                               num_workers=num_workers)
+                                               shuffle=sampler is None,
+                                               sampler=sampler,
+                                               num_workers=num_workers,
+                                               pin_memory=True,
+                                               # a smaller final batch would make cudnn benchmark autotune again
+                                               drop_last=True,
+                                               **worker_kw)
 
     return train_loader
 
 # load test data and validation data (here, test == validation)
 def load_test_data(batch_size, dataset, num_workers):
 
-    if dataset == 'Cifar10':
-        param_mean = (0.4914, 0.4822, 0.4465)
-        param_std = (0.2471, 0.2435, 0.2616)
-        transform_test = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(param_mean, param_std),
-        ])
-
-        test_set = torchvision.datasets.CIFAR10(root='./data',
-                                                train=False,
-                                                download=True,
-                                                transform=transform_test)
-    elif dataset == 'Cifar100':
-        param_mean = (0.5071, 0.4867, 0.4408)
-        param_std = (0.2675, 0.2565, 0.2761)
-                 
-        transform_test = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(param_mean, param_std),
-        ])
-
-        test_set = torchvision.datasets.CIFAR100(root='./data',
-                                                train=False,
-                                                download=True,
-                                                transform=transform_test)                                    
+    if dataset == 'Cifar10' or dataset == 'Cifar100':
+        test_set = CachedCIFAR(dataset, train=False)
     
     elif dataset == 'Imagenet':
-        param_mean = [0.485, 0.456, 0.406]
-        param_std = [0.229, 0.224, 0.225]
-                 
-        transform_train = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize(param_mean, param_std),
-        ])
-
         train_set = torchvision.datasets.ImageNet(root='./data',
                                                 train=True,
                                                 download=True,
-                                                transform=transform_train)  
+                                                transform=transforms.PILToTensor())
     else:
         raise NotImplementedError('unknown dataset: '+dataset)                                            
+    worker_kw = {'persistent_workers': True, 'prefetch_factor': 2} if num_workers > 0 else {}
     test_loader = torch.utils.data.DataLoader(test_set,
                                                 batch_size=batch_size,
                                                 shuffle=False,
-                                                num_workers=num_workers)                                              
+                                                num_workers=num_workers,
+                                                pin_memory=True,
+                                                **worker_kw)                                              
 
     return test_loader
 
+# training data kept on the device, augmentation done batch-wise with tensor ops
+class GPUCifar:
+    def __init__(self, dataset, batch_size, device, augment=True, rank=0, world_size=1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.device = device
+        self.augment = augment
+        self.rank, self.world_size = rank, world_size
+        # same seed on every rank, so the shards of one permutation do not overlap
+        self.generator = torch.Generator().manual_seed(torch.initial_seed())
+        # uint8 images, normalized in model_train like the loader batches
+        self.data = dataset.data.to(device)
+        self.targets = dataset.targets.to(device)
+
+    def __len__(self):
+        num = (len(self.targets) - self.rank + self.world_size - 1) // self.world_size
+        return num // self.batch_size
+
+    def __iter__(self):
+        perm = torch.randperm(len(self.targets), generator=self.generator)
+        perm = perm[self.rank::self.world_size].to(self.device)
+        # drop the last partial batch like load_train_data
+        num = len(perm) - len(perm) % self.batch_size
+        for start in range(0, num, self.batch_size):
+            idx = perm[start:start + self.batch_size]
+            inputs = self.data[idx]
+            if self.augment:
+                inputs = self.crop_flip(inputs)
+            yield inputs, self.targets[idx]
+
+    @staticmethod
+    def crop_flip(x, padding=4):
+        # RandomCrop(padding=4) with zero fill, then RandomHorizontalFlip
+        b, _, h, w = x.shape
+        x = F.pad(x, [padding] * 4)
+        i = torch.randint(0, 2 * padding + 1, (b, 1, 1), device=x.device)
+        j = torch.randint(0, 2 * padding + 1, (b, 1, 1), device=x.device)
+        rows = i + torch.arange(h, device=x.device).view(1, h, 1)
+        cols = j + torch.arange(w, device=x.device).view(1, 1, w)
+        batch = torch.arange(b, device=x.device).view(b, 1, 1)
+        x = x[batch, :, rows, cols].permute(0, 3, 1, 2)
+        flip = torch.rand(b, device=x.device) < 0.5
+        return torch.where(flip.view(b, 1, 1, 1), x.flip(3), x)
+
+def load_train_data_gpu(batch_size, dataset, device, rank=0, world_size=1):
+    # same augmentation as load_train_data
+    if dataset == 'Cifar10':
+        return GPUCifar(CachedCIFAR(dataset, train=True), batch_size, device, augment=False,
+                        rank=rank, world_size=world_size)
+    elif dataset == 'Cifar100':
+        return GPUCifar(CachedCIFAR(dataset, train=True), batch_size, device,
+                        rank=rank, world_size=world_size)
+    else:
+        raise NotImplementedError('gpu data loading not supported for dataset: '+dataset)
+
 # Define a hook
 features = {}
 def get_features(name):
@@ -414,29 +515,70 @@ def get_features(name):
 
     return hook
 
-def initial_test(model, val_loader, device, num_classes):
+def store_features(buf, output, start, num):
+    # write a batch of flattened features into a (num, dim) buffer kept on the device
+    output = output.flatten(1)
+    if buf is None:
+        buf = torch.empty((num, output.size(1)), device=output.device)
+    buf[start:start + output.size(0)].copy_(output)
+    return buf
+
+def initial_test(model, val_loader, device, num_classes, normalize, amp_dtype=None, memory_format=torch.contiguous_format):
     # validation phase
     model.eval()
-    f_out = torch.empty((0, num_classes))
-    with torch.no_grad():
-        correct, total = 0, 0
+    # pinned buffer so logits are copied back asynchronously
+    f_out = torch.empty((len(val_loader.dataset), num_classes), pin_memory=device.type == 'cuda')
+    with torch.inference_mode():
+        # accumulate on device, sync once at the end
+        correct, total = torch.zeros((), dtype=torch.long, device=device), 0
         for _, data in enumerate(val_loader, 0):
             inputs, labels = data
-            inputs, labels = inputs.to(device), labels.to(device)
-            outputs = model(inputs)
-            _, predicted = torch.max(outputs.data, 1)
+            inputs, labels = inputs.to(device, memory_format=memory_format, non_blocking=True), labels.to(device, non_blocking=True)
+            inputs = normalize(inputs)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(inputs)
+            predicted = outputs.argmax(1)
+            f_out[total:total + labels.size(0)].copy_(outputs.detach(), non_blocking=True)
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
-            f_out = torch.vstack((f_out, outputs.detach().cpu()))
+            correct += (predicted == labels).sum()
+        # .item() waits for the stream, including the pending copies into f_out
+        acc = correct.item()/total
         weight = list(model.state_dict().items())[-1][1].detach().cpu()
-    return f_out, weight, correct/total
+    return f_out, weight, acc
+
+def augmented_mse_loss(outputs, one_hot, k, M):
+    # (weight * (outputs - M * one_hot)**2).mean() with weight = k * one_hot + 1, without the ones tensor
+    weight = one_hot.mul(k).add_(1)
+    return (outputs.float().sub(one_hot, alpha=M).square() * weight).mean()
+
+def soft_mse_loss(outputs, one_hot):
+    # squared error between softmax probabilities and one-hot targets
+    return (outputs.float().softmax(1) - one_hot).square().mean()
+
+def freeze_for_eval(model):
+    # scripted and frozen copy for inference: folds conv+bn and fuses conv+add+relu
+    try:
+        return torch.jit.optimize_for_inference(torch.jit.script(model.eval()))
+    except Exception as e:
+        print('freeze_eval disabled: '+str(e))
+        return None
+
+def fuse_bn_for_eval(model):
+    # copy of the model with every conv+bn pair folded into a single conv
+    try:
+        return torch.fx.experimental.optimization.fuse(model.eval())
+    except Exception as e:
+        print('fuse_bn_eval disabled: '+str(e))
+        return None
 
 def init_scale(model, scale):
-    state_dict = model.state_dict()
-    for i in range(len(state_dict.keys())):
-        name = list(model.state_dict())[i]
-        state_dict[name] = state_dict[name]*scale
-    model.load_state_dict(state_dict)
+    # in place, so it runs on whatever device the model already lives on
+    with torch.no_grad():
+        for p in model.parameters():
+            p.mul_(scale)
+        for b in model.buffers():
+            if b.is_floating_point():
+                b.mul_(scale)
     return model
 
 def info(data):
@@ -466,27 +608,47 @@ def model_train(args):
     batch_size = args.batch_size
     
     # load data and model to device
-    train_loader = load_train_data(batch_size, args.data,
-                                   num_workers=0)
-    if args.gradient:
-        val_loader = load_test_data(24, args.data, num_workers=0)
+    distributed = dist.is_available() and dist.is_initialized()
+    if distributed:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        device = torch.device("cuda", int(os.environ['LOCAL_RANK']))
+    else:
+        rank, world_size = 0, 1
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    train_norm = DeviceNormalize(*data_stats(args.data, train=True), device)
+    val_norm = DeviceNormalize(*data_stats(args.data, train=False), device)
+    if args.gpu_data:
+        train_loader = load_train_data_gpu(batch_size, args.data, device, rank, world_size)
     else:
-        val_loader = load_test_data(batch_size, args.data, num_workers=0)
+        train_loader = load_train_data(batch_size, args.data,
+                                       num_workers=args.num_workers, distributed=distributed)
+    # the jacobian of a batch is (classes, batch, params), so --gradient keeps small batches by default
+    val_batch_size = args.val_batch_size or (24 if args.gradient else batch_size)
+    val_loader = load_test_data(val_batch_size, args.data, num_workers=args.num_workers)
     
     num_chann, num_classes, pic_size = info(args.data)
     model_name = args.model
     model = load_architecture(model_name, num_chann, num_classes, pic_size)
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    feature_module = penultimate_module(model, model_name)
+    if args.checkpoint_segments > 0:
+        model = checkpoint_stages(model, model_name, args.checkpoint_segments)
 
 
     # initialization scale
-    init_scale(model, args.init_scale).to(device)
+    init_scale(model.to(device), args.init_scale)
+    # NHWC layout for the conv backbones, cudnn's native format for tensor-core kernels
+    memory_format = torch.contiguous_format
+    if model_name in ('resnet18', 'resnet34', 'resnet50', 'vgg11', 'alexnet', 'wide-resnet', 'swim-net'):
+        memory_format = torch.channels_last
+        model.to(memory_format=memory_format)
 
     # loss func
     if args.loss_fn == 'mse_loss':
         criterion = nn.MSELoss()
     elif args.loss_fn == 'ce_loss':
         criterion = nn.CrossEntropyLoss()
+    elif args.loss_fn == 'soft_mse':
+        criterion = None
     else:
         raise NotImplementedError('unknown loss func: '+args.loss_fn)
     LR = args.lr_setting[0] 
@@ -512,14 +674,15 @@ def model_train(args):
     if args.lr_setting[1]>0:
         init_lr = args.lr_setting[2]
         warmtime = args.lr_setting[1]
-        lin_rate = (LR - init_lr)/(warmtime-1)
-        lambda1 = lambda epoch: init_lr+lin_rate*epoch
+        # factors are relative to the base lr LR: init_lr -> LR linearly over the warm-up epochs;
+        # LambdaLR rather than LinearLR, which rejects init_lr=0 and init_lr>LR
+        lin_steps = max(int(warmtime)-1, 1)
+        lambda1 = lambda epoch: (init_lr + (LR - init_lr) * min(epoch, lin_steps) / lin_steps) / LR
         end = warmtime
         scheduler1 = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda1)
     else:
-        lambda1 = lambda epoch: LR
         end = 0
-        scheduler1 = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=lambda1)
+        scheduler1 = torch.optim.lr_scheduler.ConstantLR(optimizer, factor=1.0, total_iters=0)
     scheduler2 = torch.optim.lr_scheduler.StepLR(optimizer,
                                                 step_size=args.decay_stepsize,
                                                 gamma=args.decay_rate)
@@ -531,12 +694,15 @@ def model_train(args):
     #
     example_ct = 0  # number of examples seen
     batch_ct = 0
-    F_out = torch.zeros((10000, num_classes, 1))
+    num_val = len(val_loader.dataset)
+    F_out = torch.empty((num_val, num_classes, EPOCH + 1))
+    f_out = torch.empty((num_val, num_classes), pin_memory=device.type == 'cuda')
     train_loss = []
     train_acc = []
     test_acc_ = []
     grad_norm = []
-    call_wandb=args.call_wandb
+    call_wandb=args.call_wandb and rank == 0
+    log_buf = []
     k, M = args.k_M
     if call_wandb:
         def train_log(loss, example_ct, epoch):
@@ -545,114 +711,179 @@ def model_train(args):
             print(f"Loss after " + str(example_ct).zfill(5) + f" examples: {loss:.3f}")
         wandb.watch(model, criterion, log="all", log_freq=100)
 
+    # mixed precision, fp16 needs loss scaling while bf16 does not
+    amp_dtype = None
+    if args.amp_dtype != 'fp32' and device.type == 'cuda':
+        amp_dtype = torch.float16 if args.amp_dtype == 'fp16' else torch.bfloat16
+    scaler = torch.cuda.amp.GradScaler(enabled=amp_dtype == torch.float16)
+    # the --gradient validation runs the autograd model for the jacobian, a frozen or fused copy would go unused
+    freeze_eval = args.freeze_eval and amp_dtype is None and not args.gradient
+    fuse_bn_eval = args.fuse_bn_eval and not args.gradient
+
+    # compiled model for the training and validation forwards; the jacobian, state_dict and the
+    # last validation epoch (where the feature hook has to fire) use the eager net
+    net = model
+    if distributed:
+        model = DDP(net, device_ids=[device.index])
+    augmented_loss, soft_loss = augmented_mse_loss, soft_mse_loss
+    if args.compile and hasattr(torch, 'compile') and device.type == 'cuda' and not args.deterministic:
+        # graphs that fail to compile run eagerly instead of aborting the run
+        torch._dynamo.config.suppress_errors = True
+        model = torch.compile(model, mode=args.compile_mode, fullgraph=False)
+        augmented_loss = torch.compile(augmented_mse_loss)
+        soft_loss = torch.compile(soft_mse_loss)
+    elif args.compile:
+        print('torch.compile skipped: needs torch>=2.0, a cuda device and --no-deterministic')
+
+    # last entry of the state_dict, the weight of the final linear layer; the detached
+    # tensor shares storage with the parameter, so it follows the optimizer updates
+    head_weight = next(reversed(net.state_dict().values()))
+
+    # the generator reads the current parameters on every call, so build it once
+    if args.gradient:
+        lc = LayerCollection.from_model(net)
+        Jac = Jacobian(net, n_output=num_classes, centering=True, layer_collection=lc)
+
     # Start Training model, train_dl, vali_dl, EPOCH, criterion, optimizer, scheduler
-    init_f_out, weight, acc = initial_test(model, val_loader, device, num_classes)
-    weights = torch.unsqueeze(weight, dim=2)
+    init_f_out, weight, acc = initial_test(model, val_loader, device, num_classes, val_norm, amp_dtype, memory_format)
+    F_out[:, :, 0] = init_f_out
+    # one-hot targets by indexing rows of the identity
+    eye = torch.eye(num_classes, device=device)
+    # last-layer weight after every epoch, preallocated like F_out
+    weights = torch.empty((*weight.shape, EPOCH + 1))
+    weights[..., 0] = weight
     test_acc_.append(acc)
     for epoch in range(EPOCH):
+        if isinstance(getattr(train_loader, 'sampler', None), DistributedSampler):
+            train_loader.sampler.set_epoch(epoch)
         model.train()
-        correct, sum_loss, total = 0, 0, 0
+        # accumulate on device, sync once per epoch
+        correct, total = torch.zeros((), dtype=torch.long, device=device), 0
+        sum_loss = torch.zeros((), device=device)
         for _, data in enumerate(train_loader, 0):
             # prepare data
             inputs, labels = data
-            inputs, labels = inputs.to(device), labels.to(device)
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            if args.data == 'Cifar100' and args.loss_fn == 'mse_loss':
-                one_hot = F.one_hot(labels, num_classes=num_classes).float()
-                ones = torch.ones_like(one_hot)
-                weight = k * one_hot + 1 * ones
-                loss = (weight * (outputs - M * one_hot)**2).mean()
-            else:
-                loss = criterion(outputs,
-                             F.one_hot(labels, num_classes=num_classes).float())
-            loss.backward()
-            optimizer.step()
-            sum_loss += loss.item()
-            _, predicted = torch.max(outputs.data, 1)
+            inputs, labels = inputs.to(device, memory_format=memory_format, non_blocking=True), labels.to(device, non_blocking=True)
+            inputs = train_norm(inputs)
+            optimizer.zero_grad(set_to_none=True)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                outputs = model(inputs)
+                if args.data == 'Cifar100' and args.loss_fn == 'mse_loss':
+                    loss = augmented_loss(outputs, eye[labels], k, M)
+                elif args.loss_fn == 'ce_loss':
+                    # class indices hit the fused log_softmax + nll kernel, no one-hot target needed
+                    loss = criterion(outputs, labels)
+                elif args.loss_fn == 'soft_mse':
+                    loss = soft_loss(outputs, eye[labels])
+                else:
+                    loss = criterion(outputs, eye[labels])
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
+            sum_loss += loss.detach()
+            predicted = outputs.detach().argmax(1)
             total += labels.size(0)
-            correct += (predicted == labels).sum().item()
+            correct += (predicted == labels).sum()
 
             if call_wandb:
                 example_ct += len(inputs)
                 batch_ct += 1
 
                 if ((batch_ct + 1) % 25) == 0:
-                    train_log(loss, example_ct, epoch)
-        train_loss.append(sum_loss)
-        training_acc = correct / total
+                    log_buf.append((example_ct, loss.detach()))
+        if call_wandb and log_buf:
+            # flush the buffered losses with a single device sync
+            losses = torch.stack([l for _, l in log_buf]).tolist()
+            for (step, _), l in zip(log_buf, losses):
+                train_log(l, step, epoch)
+            log_buf.clear()
+        if distributed:
+            # sum the per-shard statistics over all ranks
+            total = torch.tensor(total, device=device)
+            for t in (sum_loss, correct, total):
+                dist.all_reduce(t)
+            total = total.item()
+        train_loss.append(sum_loss.item())
+        training_acc = correct.item() / total
         train_acc.append(training_acc)
         if call_wandb:
             wandb.log({"train_accuracy": training_acc})
 
         # validation phase
-        weight = list(model.state_dict().items())[-1][1].detach().cpu()
-        weights = torch.cat([weights, torch.unsqueeze(weight, 2)], dim=2)
+        weight = head_weight.cpu()
+        weights[..., epoch + 1] = weight
         if epoch == EPOCH - 1:
             feature_name = 'phi'
-            if model_name == 'vgg11' or model_name == 'alexnet':
-                handle = model.classifier[5].register_forward_hook(get_features(feature_name))
-            elif model_name == 'vit':
-                handle = model[2][4].register_forward_hook(get_features(feature_name))
-            else:
-                second_to_last = list(model.__dict__['_modules'].keys())[-2]
-                handle = getattr(model, second_to_last).register_forward_hook(get_features(feature_name))
-            FEATS = []
+            handle = feature_module.register_forward_hook(get_features(feature_name))
+            phi_buf = None
         
         model.eval()
-        f_out = torch.empty((0, num_classes))
+        # the last epoch runs the eager net: a graph compiled in earlier epochs does not guard on
+        # module hooks, so the feature hook registered above would never fire through it
+        eval_model = net if epoch == EPOCH - 1 else model
+        if freeze_eval and epoch != EPOCH - 1:
+            eval_model = freeze_for_eval(net)
+            if eval_model is None:
+                freeze_eval, eval_model = False, model
+        elif fuse_bn_eval and epoch != EPOCH - 1:
+            eval_model = fuse_bn_for_eval(net)
+            if eval_model is None:
+                fuse_bn_eval, eval_model = False, model
         if args.gradient==True:
-            correct, total = 0, 0
-            num_batch = len(val_loader)
-            lc = LayerCollection.from_model(model)
-            Jac = Jacobian(model, n_output=num_classes, centering=True, layer_collection=lc)
-            grad_norm_ = 0
+            correct, total = torch.zeros((), dtype=torch.long, device=device), 0
+            grad_norm_ = torch.zeros((), device=device)
             for _, data in enumerate(val_loader, 0):
                 inputs, labels = data
-                inputs, labels = inputs.to(device), labels.to(device)
-                outputs = model(inputs)
-                _, predicted = torch.max(outputs.data, 1)
-                total += labels.size(0)
-                correct += (predicted == labels).sum().item()
-                f_out = torch.vstack((f_out, outputs.detach().cpu()))
+                inputs, labels = inputs.to(device, memory_format=memory_format, non_blocking=True), labels.to(device, non_blocking=True)
+                inputs = val_norm(inputs)
+                outputs = eval_model(inputs)
+                predicted = outputs.detach().argmax(1)
+                f_out[total:total + labels.size(0)].copy_(outputs.detach(), non_blocking=True)
                 if epoch == EPOCH - 1:
-                    FEATS.append(features[feature_name].cpu().numpy())
-                grad_norm_ += torch.norm((Jac.get_jacobian([inputs, labels])).detach().cpu(), 'fro')**2
-            F_out = torch.cat([F_out, torch.unsqueeze(f_out, 2)], dim=2)
-            test_acc = correct / total
+                    phi_buf = store_features(phi_buf, features[feature_name], total, num_val)
+                total += labels.size(0)
+                correct += (predicted == labels).sum()
+                # squared frobenius norm reduced on device, only the final scalar leaves the gpu;
+                # squared in place, the (classes, batch, params) jacobian is too large to copy
+                grad_norm_ += Jac.get_jacobian([inputs, labels]).detach().square_().sum()
+            test_acc = correct.item() / total
+            F_out[:, :, epoch + 1] = f_out
             test_acc_.append(test_acc)
-            grad_norm.append(torch.sqrt(grad_norm_).detach().cpu()*1e-4)
+            grad_norm.append(torch.sqrt(grad_norm_).item()*1e-4)
             # test_accs.append(test_acc)
         else:
-            with torch.no_grad():
-                correct, total = 0, 0
-                num_batch = len(val_loader)
+            with torch.inference_mode():
+                correct, total = torch.zeros((), dtype=torch.long, device=device), 0
                 for _, data in enumerate(val_loader, 0):
                     inputs, labels = data
-                    inputs, labels = inputs.to(device), labels.to(device)
-                    outputs = model(inputs)
-                    _, predicted = torch.max(outputs.data, 1)
-                    total += labels.size(0)
-                    correct += (predicted == labels).sum().item()
-                    f_out = torch.vstack((f_out, outputs.detach().cpu()))
+                    inputs, labels = inputs.to(device, memory_format=memory_format, non_blocking=True), labels.to(device, non_blocking=True)
+                    inputs = val_norm(inputs)
+                    with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                        outputs = eval_model(inputs)
+                    predicted = outputs.argmax(1)
+                    f_out[total:total + labels.size(0)].copy_(outputs.detach(), non_blocking=True)
                     if epoch == EPOCH - 1:
-                        FEATS.append(features[feature_name].cpu().numpy())
-                F_out = torch.cat([F_out, torch.unsqueeze(f_out, 2)], dim=2)
-                test_acc = correct / total
+                        phi_buf = store_features(phi_buf, features[feature_name], total, num_val)
+                    total += labels.size(0)
+                    correct += (predicted == labels).sum()
+                # .item() waits for the stream, including the pending copies into f_out
+                test_acc = correct.item() / total
+                F_out[:, :, epoch + 1] = f_out
                 test_acc_.append(test_acc)
         if call_wandb:
             wandb.log({"test_accuracy": test_acc})
 
         if epoch == EPOCH - 1:
-            phi = torch.flatten(torch.from_numpy(FEATS[0]), 1)
-            for i in range(num_batch - 1):
-                phi = torch.vstack(
-                    (phi, torch.flatten(torch.from_numpy(FEATS[i + 1]), 1)))
+            phi = phi_buf.cpu()
             handle.remove()
-            beta = list(model.state_dict().items())[-1][1].detach().cpu()
+            beta = head_weight.cpu()
         scheduler.step()
-    F_out[:, :, 0] = init_f_out
-    return model.state_dict(), beta, phi, F_out, train_loss, train_acc, test_acc_, grad_norm, weights
+    return net.state_dict(), beta, phi, F_out, train_loss, train_acc, test_acc_, grad_norm, weights
+
+def ddp_setup():
+    # torchrun provides RANK, WORLD_SIZE, LOCAL_RANK and the rendezvous address
+    dist.init_process_group('nccl')
+    torch.cuda.set_device(int(os.environ['LOCAL_RANK']))
 
 def arg_parser():
     # parsers
@@ -660,9 +891,10 @@ def arg_parser():
     parser.add_argument('--model', default='resnet18', help='type of model')
     parser.add_argument('--init_scale', default=1, type=float, help='scale model initial parameter')
     parser.add_argument('--data', default='Cifar10', help='type of dataset')
-    parser.add_argument('--loss_fn', default='mse_loss', help='loss type')
+    parser.add_argument('--loss_fn', default='mse_loss', help='loss type: mse_loss, ce_loss or soft_mse')
     parser.add_argument('--optimizer', default='sgd', help='optimizer type')
     parser.add_argument('--batch_size', default=256, type=int, help='batch size')
+    parser.add_argument('--val_batch_size', default=0, type=int, help='validation batch size, 0 uses 24 with --gradient and --batch_size otherwise')
     parser.add_argument('--num_epoch', default=310, type=int, help='number of epoch')
     parser.add_argument('--lr_setting', default=[1e-1, 5, 1e-2], nargs='*', type = float, help='settings for tuning learning rate: [max_learning rate, warm_up epochsinitial_lr]')
     parser.add_argument('--decay_rate', default=0.33, type=float, help='the decay rate in each stepsize decay')
@@ -677,10 +909,68 @@ def arg_parser():
     parser.add_argument('--log', default='essential', type=str, help='how much we want to document')
     parser.add_argument('--k_M', default=[5, 5], nargs='*', type = float, help='loss augumenting for cifar-100 data: weight = k * one_hot + 1 * ones, loss = (weight * (outputs - M * one_hot)**2).mean()')
     parser.add_argument('--scheduler', default='default', type=str, help='what scheduler for vit')
+    parser.add_argument('--svd_rank', default=0, type=int, help='rank (>= 5) of the randomized svd of the penultimate features, 0 computes the exact svd')
+    parser.add_argument('--plot_formats', default=['png', 'pdf'], nargs='*', type=str, help='file formats every plot is saved in')
+    parser.add_argument('--deterministic', default=False, action='store_true', help='use deterministic cudnn algorithms (slower)')
+    parser.add_argument('--no-deterministic', dest='deterministic', action='store_false')
+    parser.add_argument('--compile', default=False, action='store_true', help='compile the model with torch.compile')
+    parser.add_argument('--no-compile', dest='compile', action='store_false')
+    parser.add_argument('--compile_mode', default='reduce-overhead', choices=['default', 'reduce-overhead', 'max-autotune'], help='torch.compile mode')
+    parser.add_argument('--num_workers', default=min(8, os.cpu_count() or 1), type=int, help='number of dataloader worker processes')
+    parser.add_argument('--gpu_data', default=False, action='store_true', help='keep the training set on gpu and augment there (Cifar10/Cifar100)')
+    parser.add_argument('--no-gpu_data', dest='gpu_data', action='store_false')
+    parser.add_argument('--freeze_eval', default=False, action='store_true', help='validate with a frozen torchscript copy of the model')
+    parser.add_argument('--no-freeze_eval', dest='freeze_eval', action='store_false')
+    parser.add_argument('--fuse_bn_eval', default=False, action='store_true', help='validate with a copy of the model whose batchnorms are folded into the convs')
+    parser.add_argument('--no-fuse_bn_eval', dest='fuse_bn_eval', action='store_false')
+    parser.add_argument('--checkpoint_segments', default=0, type=int, help='activation checkpointing segments per stage for resnet/wide-resnet/vgg11, 0 disables it')
+    parser.add_argument('--amp_dtype', default='fp32', choices=['fp32', 'fp16', 'bf16'], help='mixed precision dtype for forward passes on gpu')
+    parser.add_argument('--amp', dest='amp_dtype', action='store_const', const='fp16', help='same as --amp_dtype=fp16')
+    parser.add_argument('--bf16', dest='amp_dtype', action='store_const', const='bf16', help='same as --amp_dtype=bf16')
 
     args = parser.parse_args()
+    if 0 < args.svd_rank < 5:
+        parser.error('--svd_rank must be 0 or at least 5, the analysis keeps 5 beta components')
+    if args.freeze_eval and args.fuse_bn_eval:
+        parser.error('--freeze_eval and --fuse_bn_eval are alternative eval models, pass only one')
     return args
 
+def save_curve(curves, path, xlabel, ylabel=None, title=None, legend_loc='best', legend_size=None,
+               label_size=None, tick_size=None, xlim=None, ylim=None, wandb_key=None, formats=('png', 'pdf')):
+    # curves are (x, y, label) triples, x=None plots against the index
+    # shared styling comes from the rcParams set in main, the sizes only override it
+    # constrained layout is solved while drawing, no separate tight_layout pass
+    fig, ax = plt.subplots(constrained_layout=True)
+    for x, y, label in curves:
+        if x is None:
+            ax.plot(y, label=label)
+        else:
+            ax.plot(x, y, label=label)
+    ax.locator_params(axis='x', nbins=8)
+    label_kw = {} if label_size is None else {'fontsize': label_size}
+    ax.set_xlabel(xlabel, **label_kw)
+    if ylabel is not None:
+        ax.set_ylabel(ylabel, **label_kw)
+    if title is not None:
+        ax.set_title(title)
+    if xlim is not None:
+        ax.set_xlim(*xlim)
+    if ylim is not None:
+        ax.set_ylim(*ylim)
+    if any(label is not None for _, _, label in curves):
+        ax.legend(loc=legend_loc, **({} if legend_size is None else {'fontsize': legend_size}))
+    if tick_size is not None:
+        ax.tick_params(labelsize=tick_size)
+    if wandb_key is not None:
+        wandb.log({wandb_key: fig})
+    # every format is a full render, so only write the requested ones
+    # skip the creator/date entries, which also makes reruns write identical files
+    metadata = {'pdf': {'Creator': None, 'Producer': None, 'CreationDate': None}, 'png': {'Software': None}}
+    for fmt in formats:
+        fig.savefig(path+'.'+fmt, metadata=metadata.get(fmt))
+    # close instead of clf, so the figure is released right away
+    plt.close(fig)
+
 def main():
     
     args = arg_parser()
@@ -691,172 +981,123 @@ def main():
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
-    from datetime import datetime
-    from pytz import timezone     
-
+    if args.deterministic:
+        torch.backends.cudnn.benchmark = False
+        torch.backends.cudnn.deterministic = True
+    else:
+        # cudnn autotuner + tf32 tensor cores, input shape is fixed
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.deterministic = False
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     Ue = timezone('US/Eastern')
     Ue_time = datetime.now(Ue)
     time = Ue_time.strftime('%m-%d-%H-%M')
 
-    dir_name = 'nb'+args.model+'-init-scale'+str(args.init_scale)+'-data'+args.data+'-ep'+str(args.num_epoch)+'-bs'+str(args.batch_size)+'-lr'+str(args.lr_setting[0])+'wp_epoch'+str(args.lr_setting[1])+'-init_lr_wp'+str(args.lr_setting[2])+'-'+args.loss_fn+'-weight_dec'+str(args.decay_rate)+'per'+str(args.decay_stepsize)+'-opt'+args.optimizer+'k'+str(args.k_M[0])+'M'+str(args.k_M[1])+'-schedu'+args.scheduler+time
-    if args.call_wandb:
+    dir_name = (f'nb{args.model}-init-scale{args.init_scale}-data{args.data}-ep{args.num_epoch}-bs{args.batch_size}'
+                f'-lr{args.lr_setting[0]}wp_epoch{args.lr_setting[1]}-init_lr_wp{args.lr_setting[2]}-{args.loss_fn}'
+                f'-weight_dec{args.decay_rate}per{args.decay_stepsize}-opt{args.optimizer}k{args.k_M[0]}M{args.k_M[1]}'
+                f'-schedu{args.scheduler}{time}')
+    # launched with torchrun: one process per gpu
+    distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    if distributed:
+        ddp_setup()
+    rank = dist.get_rank() if distributed else 0
+
+    if args.call_wandb and rank == 0:
         wandb.init(project=args.model+args.data, name=dir_name, 
            entity="incremental-learning-basis-decomposition")
         wandb.config.update(args)
     
-    _, beta, Phi, F_out, train_loss, train_acc, test_acc_, grad_norm, weights= model_train(args)
+    state_dict, beta, Phi, F_out, train_loss, train_acc, test_acc_, grad_norm, weights= model_train(args)
+    # the state_dict views keep every gpu parameter alive, drop them before releasing the cache
+    del state_dict
+    if torch.cuda.is_available():
+        # the analysis below runs on the cpu, hand the cached blocks back
+        torch.cuda.empty_cache()
+    # the per-epoch curves are lists of floats, convert once for plotting and saving
+    train_loss, train_acc, test_acc_, grad_norm = map(np.asarray, (train_loss, train_acc, test_acc_, grad_norm))
+    if distributed:
+        dist.destroy_process_group()
+        # only rank 0 saves and plots
+        if rank != 0:
+            return
 
     # save model
     if args.path != 'none':
         dir_name = args.path
-    os.makedirs(dir_name)
+    # a rerun into the same --path must not crash after training has finished
+    os.makedirs(dir_name, exist_ok=True)
 
-    # plotting style
+    # plotting style, set once for every figure
     plt.style.use('seaborn-paper')
-    plt.rcParams['savefig.dpi'] = 300
-    plt.rcParams['figure.dpi'] = 150
-
-    plt.plot(train_loss, linewidth=2, label='train loss')
-    plt.locator_params(axis='x', nbins=8)
-    plt.legend(prop={'size': 10})
-    axes = plt.gca()
-    plt.xlabel("epoch", color='k')
-    plt.legend(loc='best', prop={'size': 18})
-    plt.title('train loss')
-    axes = plt.gca()
-    axes.xaxis.label.set_size(18)
-    axes.yaxis.label.set_size(18)
-    plt.xticks(color='k', fontsize=14)
-    plt.yticks(color='k', fontsize=14)
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(dir_name+'/'+args.model+'train_loss')
-    plt.savefig(dir_name+'/'+args.model+'train_loss.pdf')
-    plt.clf()
-
-    plt.plot(train_acc, linewidth=2, label='train acc')
-    plt.locator_params(axis='x', nbins=8)
-    plt.legend(prop={'size': 10})
-    axes = plt.gca()
-    plt.xlabel("epoch", color='k')
-    plt.legend(loc='best', prop={'size': 18})
-    plt.title('training accuracy')
-    axes = plt.gca()
-    axes.xaxis.label.set_size(18)
-    axes.yaxis.label.set_size(18)
-    plt.xticks(color='k', fontsize=14)
-    plt.yticks(color='k', fontsize=14)
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(dir_name+'/'+args.model+'train_acc')
-    plt.savefig(dir_name+'/'+args.model+'train_acc.pdf')
-    plt.clf()
-
-    plt.plot(test_acc_, linewidth=2, label='test acc')
-    plt.locator_params(axis='x', nbins=8)
-    plt.legend(prop={'size': 10})
-    axes = plt.gca()
-    plt.xlabel("epoch", color='k')
-    plt.legend(loc='best', prop={'size': 18})
-    plt.title('test acc')
-    axes = plt.gca()
-    axes.xaxis.label.set_size(18)
-    axes.yaxis.label.set_size(18)
-    plt.xticks(color='k', fontsize=14)
-    plt.yticks(color='k', fontsize=14)
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig(dir_name+'/'+args.model+'test_acc')
-    plt.savefig(dir_name+'/'+args.model+'test_acc.pdf')
-    plt.clf()
+    plt.rcParams.update({'savefig.dpi': 300, 'figure.dpi': 150, 'lines.linewidth': 2, 'axes.grid': True,
+                         'axes.labelsize': 18, 'axes.labelcolor': 'k', 'xtick.labelsize': 14, 'ytick.labelsize': 14,
+                         'xtick.labelcolor': 'k', 'ytick.labelcolor': 'k', 'legend.fontsize': 18})
+
+    save_curve([(None, train_loss, 'train loss')], dir_name+'/'+args.model+'train_loss', 'epoch', title='train loss',
+               formats=args.plot_formats)
+    save_curve([(None, train_acc, 'train acc')], dir_name+'/'+args.model+'train_acc', 'epoch', title='training accuracy',
+               formats=args.plot_formats)
+    save_curve([(None, test_acc_, 'test acc')], dir_name+'/'+args.model+'test_acc', 'epoch', title='test acc',
+               formats=args.plot_formats)
 
     if args.gradient:
-        keys = list(F_out.keys())
-        fn_norm = []
-        for i in range(len(keys)):
-            fn_norm.append(1e-4*torch.norm(F_out[keys[i]], 'fro'))
-
-        plt.plot([torch.log(x) for x in fn_norm], [torch.log(x) for x in grad_norm], linewidth=2)
-        plt.locator_params(axis='x', nbins=8)
-        plt.legend(prop={'size': 10})
-        axes = plt.gca()
-        plt.xlabel("log(output_norm)", color='k')
-        plt.ylabel("log(output_grad_norm)", color='k')
-        plt.legend(loc='best', prop={'size': 18})
-        plt.title('grad_fn')
-        axes = plt.gca()
-        axes.xaxis.label.set_size(18)
-        axes.yaxis.label.set_size(18)
-        plt.xticks(color='k', fontsize=14)
-        plt.yticks(color='k', fontsize=14)
-        plt.grid(True)
-        plt.tight_layout()
-        if args.call_wandb:
-            wandb.log({"beta_5": plt.gcf()})
-        plt.savefig(dir_name+'/'+args.model+'grad_fn')
-        plt.savefig(dir_name+'/'+args.model+'grad_fn.pdf')
-        plt.clf()
-
-    U, S, V = torch.svd(Phi)
-    beta_star = torch.matmul(beta, V)
-    Coe = {}
-    for i in range(5):
-        Coe[i+1] = []
+        # frobenius norm of the outputs after every epoch, slot 0 is before training and has no grad_norm
+        fn_norm = 1e-4*torch.linalg.vector_norm(F_out[:, :, 1:], dim=(0, 1))
+        log_fn = torch.log(fn_norm).numpy()
+        log_gn = np.log(grad_norm)
+
+        save_curve([(log_fn, log_gn, None)],
+                   dir_name+'/'+args.model+'grad_fn', 'log(output_norm)', ylabel='log(output_grad_norm)',
+                   title='grad_fn', wandb_key='grad_fn' if args.call_wandb else None,
+                   formats=args.plot_formats)
+
+    if args.svd_rank > 0:
+        # randomized range finder, only the top svd_rank directions of Phi enter beta_val
+        # svd_lowrank fails for q above the feature dimension
+        U, S, V = torch.svd_lowrank(Phi, q=min(args.svd_rank, *Phi.shape), niter=4)
+    else:
+        # Phi and beta already live on the cpu, where lapack handles the tall-skinny case well
+        U, S, Vh = torch.linalg.svd(Phi, full_matrices=False)
+        V = Vh.mH
     _, _, Iter = weights.shape
     A = torch.matmul(V, torch.diag(S))
     beta_val = torch.matmul(beta, A)/100
 
-    u, s, v = torch.svd(beta_val)
-    m, n = beta_val.shape
+    u, s, vh = torch.linalg.svd(beta_val, full_matrices=False)
+    v = vh.mH
 
     # spars = list(torch.norm(beta_val, dim=0))
     # top5 = sorted(range(len(spars)), key=lambda i: spars[i], reverse=True)[:5]
-    
-    for iter in range(Iter):
-    
-        beta_val = torch.matmul(F_out[:, :, iter].t(), U)/100
-        # beta_norm = torch.norm(beta_val, dim=0)
-        for i in range(5):
-            coe = torch.mul(beta_val, u[:, i].reshape((m, 1)) @ v[:, i].reshape((n, 1)).T).sum()
-            Coe[i+1].append(coe)
-            if args.call_wandb:
-                wandb.log({'epoch':iter+1, 'beta_'+str(i+1): coe})
-
-    data_dict = {'test_acc':test_acc_, 'train_acc': train_acc, 'train_loss':train_loss, 'grad_norm': grad_norm, 'svd_s': S, 'spars': s}
-    np.save(dir_name+'/data_dict.npy', data_dict)
-    np.save(dir_name+'/coe.npy', Coe) 
+
+    # coe[t, i] = u_i^T (F_out[:, :, t]^T U / 100) v_i for all epochs t at once
+    proj = torch.einsum('jct,ji->tci', F_out, U @ v[:, :5])
+    coe = (proj * u[:, :5]).sum(1)/100
+    # (Iter, 5) array shared by the wandb log, the saved file and the plot
+    coe_np = coe.numpy()
+    x_axis = np.arange(Iter)
+    if args.call_wandb:
+        # one step per epoch with all five coefficients
+        for iter in range(Iter):
+            wandb.log({'epoch': iter+1, **{'beta_'+str(i+1): c for i, c in enumerate(coe_np[iter].tolist())}})
+
+    # named plain arrays, loading them does not need allow_pickle
+    np.savez(dir_name+'/data_dict.npz', test_acc=test_acc_, train_acc=train_acc, train_loss=train_loss,
+             grad_norm=grad_norm, svd_s=S.numpy(), spars=s.numpy())
+    # row i holds beta_{i+1} over the epochs
+    np.save(dir_name+'/coe.npy', coe_np.T)
     if args.log == 'detail':
         torch.save(Phi, dir_name+'/Phi')
         torch.save(F_out, dir_name+'/F_out')
         torch.save(beta, dir_name+'/beta')
+    # the (N, C, epochs+1) outputs and the features are not needed for plotting
+    del F_out, Phi, proj
 
-    for i in range(5):
-        i_1 = i + 1
-        plt.plot(range(Iter), [x for x in Coe[i + 1]][0:Iter],
-                linewidth=2,
-                label=r'$\beta_{%s}$' % i_1)
-    plt.xlim(0,300)
-    plt.ylim(0,)
-    plt.locator_params(axis='x', nbins=8)
-    plt.legend(prop={'size': 16})
-    axes = plt.gca()
-    plt.xlabel("epoch", color='k')
-    plt.ylabel("scale", color='k')
-    plt.legend(loc='lower right', prop={'size': 22})
-    axes = plt.gca()
-    axes.xaxis.label.set_size(20)
-    axes.yaxis.label.set_size(20)
-    plt.xticks(color='k', fontsize=16)
-    plt.yticks(color='k', fontsize=16)
-    plt.grid(True)
-    plt.tight_layout()
-    if args.call_wandb:
-        wandb.log({"beta_5": plt.gcf()})
-    plt.savefig(dir_name+'/'+args.model+'beta-5')
-    plt.savefig(dir_name+'/'+args.model+'beta-5.pdf')
-    plt.clf()
+    save_curve([(x_axis, coe_np[:, i], r'$\beta_{%s}$' % (i + 1)) for i in range(5)],
+               dir_name+'/'+args.model+'beta-5', 'epoch', ylabel='scale', legend_loc='lower right',
+               legend_size=22, label_size=20, tick_size=16, xlim=(0, 300), ylim=(0, None),
+               wandb_key='beta_5' if args.call_wandb else None, formats=args.plot_formats)
 
     return
 